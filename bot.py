@@ -28,21 +28,42 @@
 
 from __future__ import with_statement
 
+import os
+import re
+import imp
 import sys
+import gzip
+import time
+import difflib
+import cProfile
+import traceback
 
 import simplejson as json
 
-from fnmatch import fnmatch
+from fnmatch import translate
+from optparse import OptionParser
 from collections import deque
 
 from twisted.words.protocols import irc
-from twisted.internet import protocol, reactor, ssl
+from twisted.internet import defer, protocol, reactor, ssl, task, threads
+from twisted.python.threadpool import ThreadPool
 
 class ChannelState(object):
     def __init__(self, name):
         self.name = name
         self.opped = False
 
+        # Bans we know are set on the channel, and the modes and kicks that are
+        # waiting to be sent in the next batch.
+        self.bans = set()
+        self.pendingModes = []
+        self.pendingKicks = []
+        self.flushCall = None
+
+        # Members of the channel, by lower cased nickname, along with the
+        # prefix modes (o, v, ...) they hold.
+        self.members = {}
+
     def getName(self):
         return self.name
 
@@ -52,6 +73,211 @@ class ChannelState(object):
     def setOpped(self, v):
         self.opped = v
 
+    def getBans(self):
+        return self.bans
+
+    def getMembers(self):
+        return self.members.keys()
+
+    def hasMember(self, nickname):
+        return nickname.lower() in self.members
+
+    def addMember(self, nickname, modes = ()):
+        self.members.setdefault(nickname.lower(), set()).update(modes)
+
+    def removeMember(self, nickname):
+        self.members.pop(nickname.lower(), None)
+
+    def renameMember(self, oldname, newname):
+        modes = self.members.pop(oldname.lower(), None)
+
+        if modes is not None:
+            self.members[newname.lower()] = modes
+
+    def setMemberModes(self, nickname, modes):
+        self.members[nickname.lower()] = set(modes)
+
+    def setMemberMode(self, nickname, mode, added):
+        modes = self.members.get(nickname.lower())
+
+        if modes is None:
+            return
+
+        if added:
+            modes.add(mode)
+        else:
+            modes.discard(mode)
+
+    def hasMemberMode(self, nickname, mode):
+        return mode in self.members.get(nickname.lower(), ())
+
+    def queueMode(self, sign, mode, argument):
+        entry = (sign, mode, argument)
+
+        if entry not in self.pendingModes:
+            self.pendingModes.append(entry)
+
+    def queueKick(self, nickname, reason):
+        for pending in self.pendingKicks:
+            if pending[0] == nickname:
+                return
+
+        self.pendingKicks.append((nickname, reason))
+
+    def takePendingModes(self):
+        modes = self.pendingModes
+        self.pendingModes = []
+        return modes
+
+    def takePendingKicks(self):
+        kicks = self.pendingKicks
+        self.pendingKicks = []
+        return kicks
+
+    def cancel(self):
+        if self.flushCall is not None and self.flushCall.active():
+            self.flushCall.cancel()
+
+        self.flushCall = None
+
+class Member(object):
+    def __init__(self, nickname):
+        self.nickname = nickname
+        self.username = None
+        self.hostname = None
+        self.account = None
+        self.accountKnown = False
+        self.away = False
+
+    def getNickname(self):
+        return self.nickname
+
+    def setNickname(self, nickname):
+        self.nickname = nickname
+
+    def setUserhost(self, username, hostname):
+        self.username = username
+        self.hostname = hostname
+
+    def getHostmask(self):
+        # Without userhost-in-names we only learn the nickname from NAMES,
+        # until a WHO reply or a JOIN fills in the rest.
+        if self.username is None or self.hostname is None:
+            return None
+
+        return Hostmask(self.nickname, self.username, self.hostname)
+
+    def getAccount(self):
+        return self.account
+
+    def setAccount(self, account):
+        self.account = account
+        self.accountKnown = True
+
+    def isAccountKnown(self):
+        # Members we only know from NAMES have no account information, which
+        # is different from knowing that they are not logged in.
+        return self.accountKnown
+
+    def isAway(self):
+        return self.away
+
+    def setAway(self, away):
+        self.away = away
+
+    def __repr__(self):
+        return self.nickname
+
+class Roster(object):
+    # Everyone we share at least one channel with, by lower cased nickname.
+    def __init__(self):
+        self.members = {}
+
+    def find(self, nickname):
+        return self.members.get(nickname.lower())
+
+    def get(self, nickname):
+        member = self.find(nickname)
+
+        if member is None:
+            member = Member(nickname)
+            self.members[nickname.lower()] = member
+
+        return member
+
+    def update(self, hostmask):
+        member = self.get(hostmask.getNickname())
+        member.setUserhost(hostmask.getUsername(), hostmask.getHostname())
+
+        return member
+
+    def rename(self, oldname, newname):
+        member = self.members.pop(oldname.lower(), None)
+
+        if member is not None:
+            member.setNickname(newname)
+            self.members[newname.lower()] = member
+
+    def remove(self, nickname):
+        self.members.pop(nickname.lower(), None)
+
+    def getMembers(self):
+        return self.members.values()
+
+def ircLower(string):
+    # rfc1459 casemapping: besides the ASCII letters, {}|^ are the lower case
+    # forms of []\~.
+    return string.lower().replace("[", "{").replace("]", "}").replace("\\", "|").replace("~", "^")
+
+class Matcher(object):
+    # Compiles one or more fnmatch-style masks into a single regular expression
+    # such that a hostmask can be checked against all of them in one go. Like
+    # fnmatch, matching is case sensitive.
+    def __init__(self, masks):
+        if masks is None:
+            masks = []
+
+        if isinstance(masks, basestring):
+            masks = [masks]
+
+        self.masks = list(masks)
+        self.regex = None
+
+        if self.masks:
+            self.regex = re.compile("|".join(["(?:%s)" % self.translate(mask) for mask in self.masks]))
+
+    def getMasks(self):
+        return self.masks
+
+    def translate(self, mask):
+        return translate(mask)
+
+    def match(self, other):
+        if self.regex is None:
+            return False
+
+        return self.regex.match(other) is not None
+
+class MaskMatcher(Matcher):
+    # Matches IRC masks the way the server does for +b: only * and ? are
+    # wildcards, so the [ ] { } \ | found in nicknames match themselves, and
+    # case is folded using rfc1459 casemapping.
+    def translate(self, mask):
+        pattern = []
+
+        for c in ircLower(mask):
+            if c == "*":
+                pattern.append(".*")
+            elif c == "?":
+                pattern.append(".")
+            else:
+                pattern.append(re.escape(c))
+
+        return "".join(pattern) + "\\Z"
+
+    def match(self, other):
+        return Matcher.match(self, ircLower(other))
+
 class Hostmask(object):
     def __init__(self, nickname, username, hostname):
         self.nickname = nickname
@@ -91,9 +317,18 @@ class Hostmask(object):
         return Hostmask(nickname, username, hostname)
 
 class Channel(object):
-    def __init__(self, name, operators):
+    def __init__(self, name, operators, bans = (), verification = ()):
         self.name = name
         self.operators = operators
+        self.verification = set(verification)
+        self.bans = {}
+        self.banMatcher = MaskMatcher([])
+        self.skipped = {}
+
+        for ban in bans:
+            self.bans[ban.getMask()] = ban
+
+        self.updateBanMatcher()
 
     def getName(self):
         return self.name
@@ -101,14 +336,152 @@ class Channel(object):
     def getOperators(self):
         return self.operators
 
+    def getVerification(self):
+        return self.verification
+
+    def addSkipped(self, key, entry):
+        self.skipped.setdefault(key, []).append(entry)
+
+    def getSkipped(self, key):
+        return self.skipped.get(key, [])
+
+    def getBans(self):
+        return self.bans.values()
+
+    def getBan(self, mask):
+        return self.bans.get(mask)
+
+    def addBan(self, ban):
+        self.bans[ban.getMask()] = ban
+        self.updateBanMatcher()
+
+    def removeBan(self, mask):
+        if mask not in self.bans:
+            return None
+
+        ban = self.bans.pop(mask)
+        self.updateBanMatcher()
+
+        return ban
+
+    def updateBanMatcher(self):
+        self.banMatcher = MaskMatcher(self.bans.keys())
+
+    def findBan(self, hostmask):
+        # The combined matcher lets us reject the common case, a user who is
+        # not banned, without looking at every single ban.
+        if not self.banMatcher.match(hostmask):
+            return None
+
+        for ban in self.bans.values():
+            if ban.match(hostmask):
+                return ban
+
+        return None
+
     def __repr__(self):
         return self.name
 
+class Ban(object):
+    durations = {
+        "s": 1,
+        "m": 60,
+        "h": 60 * 60,
+        "d": 24 * 60 * 60,
+        "w": 7 * 24 * 60 * 60
+    }
+
+    def __init__(self, mask, reason, expires):
+        self.mask = mask
+        self.reason = reason
+        self.expires = expires
+        # Servers match bans without regard to case, and so must we, or a
+        # clone could get past a ban by changing the case of its ident.
+        self.matcher = MaskMatcher(mask)
+
+    def getMask(self):
+        return self.mask
+
+    def getReason(self):
+        return self.reason
+
+    def getExpires(self):
+        return self.expires
+
+    def isExpired(self, now):
+        return self.expires is not None and self.expires <= now
+
+    def match(self, other):
+        return self.matcher.match(other)
+
+    def __repr__(self):
+        return self.mask
+
+    @staticmethod
+    def parseDuration(duration):
+        # Accepts plain seconds or a number followed by one of the units in
+        # Ban.durations, like "30m" or "7d".
+        multiplier = 1
+
+        if duration and duration[-1] in Ban.durations:
+            multiplier = Ban.durations[duration[-1]]
+            duration = duration[:-1]
+
+        if not duration.isdigit():
+            return None
+
+        return int(duration) * multiplier
+
+class TimerWheel(object):
+    # A hashed timer wheel: every slot covers `resolution` seconds and entries
+    # further away than a full revolution carry a count of the remaining
+    # rounds. Advancing the wheel only touches the slots that have passed.
+    def __init__(self, resolution, size, now):
+        self.resolution = resolution
+        self.size = size
+        self.slots = [[] for i in range(size)]
+        self.position = 0
+        self.current = now
+
+    def getResolution(self):
+        return self.resolution
+
+    def schedule(self, when, item):
+        ticks = int((when - self.current + self.resolution - 1) // self.resolution)
+        ticks = max(1, ticks)
+
+        slot = (self.position + ticks) % self.size
+        rounds = (ticks - 1) // self.size
+
+        self.slots[slot].append([rounds, item])
+
+    def advance(self, now):
+        r = []
+
+        while self.current + self.resolution <= now:
+            self.current += self.resolution
+            self.position = (self.position + 1) % self.size
+
+            remaining = []
+
+            for entry in self.slots[self.position]:
+                if entry[0] == 0:
+                    r.append(entry[1])
+                else:
+                    entry[0] -= 1
+                    remaining.append(entry)
+
+            self.slots[self.position] = remaining
+
+        return r
+
 class User(object):
-    def __init__(self, name, mask, userclass):
+    def __init__(self, name, mask, userclass, account = None):
         self.name = name
         self.mask = mask
         self.userClass = userclass
+        self.account = account
+        self.matcher = Matcher(mask)
 
     def getName(self):
         return self.name
@@ -119,8 +492,18 @@ class User(object):
     def getMask(self):
         return self.mask
 
+    def getAccount(self):
+        return self.account
+
     def match(self, other):
-        return fnmatch(other, self.mask)
+        return self.matcher.match(other)
+
+    def matchAccount(self, account):
+        # Services account names are case insensitive, like nicknames.
+        if self.account is None or account is None:
+            return False
+
+        return self.account.lower() == account.lower()
 
     def __repr__(self):
         return self.name
@@ -159,11 +542,11 @@ class UserRegistry(object):
     def getUsers(self):
         return self.users.values()
 
-    def findMatches(self, hostmask):
+    def findMatches(self, hostmask, account = None):
         r = []
 
         for user in self.users.values():
-            if user.match(hostmask.getHostmask()):
+            if user.match(hostmask.getHostmask()) or user.matchAccount(account):
                 r.append(user)
 
         return r
@@ -177,6 +560,13 @@ class Configuration(object):
         self.channels = {}
         self.userRegistry = UserRegistry()
         self.currentServer = None
+        self.pluginDirectory = None
+        self.pluginThreads = 4
+
+        # Entries we could not make sense of. They are written back as they
+        # were when saving, such that fixing the configuration file remains
+        # up to whoever wrote it.
+        self.skipped = {}
 
         # Errors and warnings.
         self.valid = True
@@ -213,6 +603,18 @@ class Configuration(object):
     def getRealname(self):
         return self.realname
 
+    def setPluginDirectory(self, directory):
+        self.pluginDirectory = directory
+
+    def getPluginDirectory(self):
+        return self.pluginDirectory
+
+    def setPluginThreads(self, threads):
+        self.pluginThreads = threads
+
+    def getPluginThreads(self):
+        return self.pluginThreads
+
     def appendErrorMessage(self, errorMessage):
         self.errorMessages.append(errorMessage)
 
@@ -225,6 +627,12 @@ class Configuration(object):
     def getWarningMessages(self):
         return self.warningMessages
 
+    def addSkipped(self, key, entry):
+        self.skipped.setdefault(key, []).append(entry)
+
+    def getSkipped(self, key):
+        return self.skipped.get(key, [])
+
     def addUser(self, user):
         self.userRegistry.registerUser(user)
 
@@ -260,6 +668,18 @@ class ConfigurationEncoder(json.JSONEncoder):
             data["bot"]["username"] = config.getUsername()
             data["bot"]["realname"] = config.getRealname()
 
+            if config.getPluginDirectory() is not None:
+                data["plugins"] = {
+                    "directory": config.getPluginDirectory(),
+                    "threads": config.getPluginThreads()
+                }
+
+                for threads in config.getSkipped("threads"):
+                    data["plugins"]["threads"] = threads
+
+            for plugins in config.getSkipped("plugins"):
+                data["plugins"] = plugins
+
             for s in config.getServers():
                 data["servers"].append({
                     "hostname": s.getHostname(),
@@ -267,26 +687,61 @@ class ConfigurationEncoder(json.JSONEncoder):
                     "ssl": s.isSecure()
                 })
 
+            data["servers"].extend(config.getSkipped("servers"))
+
             for u in config.getUsers():
-                data["users"].append({
+                user = {
                     "name": u.getName(),
-                    "mask": u.getMask(),
                     "class": u.getUserClass()
-                })
+                }
+
+                if u.getMask() is not None:
+                    user["mask"] = u.getMask()
+
+                if u.getAccount() is not None:
+                    user["account"] = u.getAccount()
+
+                data["users"].append(user)
+
+            data["users"].extend(config.getSkipped("users"))
 
             for c in config.getChannels():
-                data["channels"].append({
+                bans = []
+
+                for b in c.getBans():
+                    ban = {
+                        "mask": b.getMask(),
+                        "reason": b.getReason()
+                    }
+
+                    if b.getExpires() is not None:
+                        ban["expires"] = b.getExpires()
+
+                    bans.append(ban)
+
+                bans.extend(c.getSkipped("bans"))
+
+                channel = {
                     "name": c.getName(),
-                    "operators": [o.getName() for o in c.getOperators()]
-                })
+                    "operators": [o.getName() for o in c.getOperators()] + c.getSkipped("operators"),
+                    "bans": bans
+                }
+
+                if c.getVerification() or c.getSkipped("verify"):
+                    channel["verify"] = sorted(c.getVerification()) + c.getSkipped("verify")
+
+                data["channels"].append(channel)
+
+            data["channels"].extend(config.getSkipped("channels"))
 
             return data
 
-        return json.JSONEncoder(self, obj)
+        return json.JSONEncoder.default(self, config)
 
 class ConfigurationDecoder(object):
     required_keys = set(["bot", "servers", "users", "channels"])
     valid_user_classes = set(["admin", "user"])
+    valid_verifications = set(["account", "secure"])
     invalid_user_masks = set(["*", "*@*", "*!*", "*!*@*"])
 
     def decode(self, obj):
@@ -334,6 +789,7 @@ class ConfigurationDecoder(object):
         for s in obj["servers"]:
             if "hostname" not in s:
                 config.appendWarningMessage("Ignored server-entry due to lack of hostname.")
+                config.addSkipped("servers", s)
                 continue
 
             hostname = s["hostname"]
@@ -349,22 +805,27 @@ class ConfigurationDecoder(object):
 
             config.addServer(Server(hostname, port, ssl))
 
-        # The only required keys for a user is the name and mask;
+        # The only required keys for a user is the name and either a mask or a
+        # services account;
         for u in obj["users"]:
             if "name" not in u:
                 config.appendWarningMessage("Ignored user-entry due to lack of name.")
+                config.addSkipped("users", u)
                 continue
 
-            if "mask" not in u:
-                config.appendWarningMessage("Ignored user-entry due to lack of mask.")
+            if "mask" not in u and "account" not in u:
+                config.appendWarningMessage("Ignored user-entry due to lack of mask and account.")
+                config.addSkipped("users", u)
                 continue
 
-            if u["mask"] in self.invalid_user_masks:
+            if "mask" in u and not self.isSecureMask(u["mask"]):
                 config.appendWarningMessage("Insecure mask for user '%s'" % u["name"])
+                config.addSkipped("users", u)
                 continue
 
             name = u["name"]
-            mask = u["mask"]
+            mask = u.get("mask")
+            account = u.get("account")
             userClass = "user"
 
             if "class" in u:
@@ -373,16 +834,19 @@ class ConfigurationDecoder(object):
                 else:
                     userClass = u["class"]
 
-            config.addUser(User(name, mask, userClass))
+            config.addUser(User(name, mask, userClass, account))
 
         # The only required key for a channel is the name itself.
         for c in obj["channels"]:
             if "name" not in c:
                 config.appendWarningMessage("Ignored channel-entry due to lack of name.")
+                config.addSkipped("channels", c)
                 continue
 
             name = c["name"]
             operators = set([])
+            bans = []
+            skipped = []
 
             # We are validating usernames here by checking with the
             # configuration object if the user has already been added.
@@ -391,16 +855,95 @@ class ConfigurationDecoder(object):
                 for operator in c["operators"]:
                     if not config.hasUser(operator):
                         config.appendWarningMessage("Unknown operator '%s'" % operator)
+                        skipped.append(("operators", operator))
                         continue
 
                     # Append the operator to the list of users. Remember the
                     # fact that objects in Python are passed as references.
                     operators.add(config.findUser(operator))
 
-            config.addChannel(Channel(name, operators))
+            # Bans use the same mask syntax as users and are subject to the
+            # same sanity check, since banning *!*@* would empty the channel.
+            if "bans" in c:
+                for b in c["bans"]:
+                    if "mask" not in b:
+                        config.appendWarningMessage("Ignored ban-entry on '%s' due to lack of mask." % name)
+                        skipped.append(("bans", b))
+                        continue
+
+                    if not self.isSecureMask(b["mask"]):
+                        config.appendWarningMessage("Insecure ban mask '%s' on '%s'" % (b["mask"], name))
+                        skipped.append(("bans", b))
+                        continue
+
+                    # A list of masks turns into one ban per mask, since each
+                    # of them is set with its own +b on the channel.
+                    masks = b["mask"]
+
+                    if isinstance(masks, basestring):
+                        masks = [masks]
+
+                    for mask in masks:
+                        bans.append(Ban(mask, b.get("reason", "Banned"), b.get("expires")))
+
+            # Things we check with WHOIS before opping someone, on top of
+            # their hostmask or account matching.
+            verification = set([])
+
+            if "verify" in c:
+                for v in c["verify"]:
+                    if v not in self.valid_verifications:
+                        config.appendWarningMessage("Ignoring invalid verification '%s' on '%s'" % (v, name))
+                        skipped.append(("verify", v))
+                        continue
+
+                    verification.add(v)
+
+            # An account can only be verified against the one we expect, so
+            # operators without one will never be opped here. We keep them
+            # around anyway, lest saving the configuration drops them.
+            if "account" in verification:
+                for operator in operators:
+                    if operator.getAccount() is None:
+                        config.appendWarningMessage("Operator '%s' on '%s' lacks an account and will not be opped." % (operator.getName(), name))
+
+            channel = Channel(name, operators, bans, verification)
+
+            for key, entry in skipped:
+                channel.addSkipped(key, entry)
+
+            config.addChannel(channel)
+
+        # Plugins are optional; without a directory the bot runs with no
+        # plugins loaded.
+        if "plugins" in obj:
+            p = obj["plugins"]
+
+            if "directory" not in p:
+                config.appendWarningMessage("Ignored plugins-entry due to lack of directory.")
+                config.addSkipped("plugins", p)
+            else:
+                config.setPluginDirectory(p["directory"])
+
+                if "threads" in p:
+                    if p["threads"] < 1:
+                        config.appendWarningMessage("Ignoring invalid number of plugin threads '%s'." % p["threads"])
+                        config.addSkipped("threads", p["threads"])
+                    else:
+                        config.setPluginThreads(p["threads"])
 
         return config
 
+    def isSecureMask(self, mask):
+        if isinstance(mask, basestring):
+            mask = [mask]
+
+        for m in mask:
+            if m in self.invalid_user_masks:
+                return False
+
+        return True
+
 class ConfigurationLoader(object):
     def load(self, filename):
         decoder = ConfigurationDecoder()
@@ -419,16 +962,28 @@ class ConfigurationSaver(object):
             f.write(content + '\n')
 
 class ConfigurationService(object):
-    def __init__(self, filename):
+    # Ban expiry is checked once per minute; a wheel of an hour covers the
+    # common short bans without any entry needing more than a single round.
+    banResolution = 60
+    banSlots = 60
+
+    # Ban expiry follows this clock, which a replay swaps for a task.Clock.
+    clock = reactor
+
+    def __init__(self, filename, readOnly = False):
         # This should only happen when the bot is initially run. In case there
         # is an error here, we must shut down since there is no configuration
         # file to revert back to.
         loader = ConfigurationLoader()
         self.filename = filename
+        self.readOnly = readOnly
         self.config = loader.load(filename)
         self.currentServer = None
         self.channelStates = {}
 
+        # Expired bans we are unable to unset yet, as (channel, mask) pairs.
+        self.heldBans = []
+
         for warning in self.config.getWarningMessages():
             print "   * %s (Warning)" % warning
 
@@ -440,6 +995,8 @@ class ConfigurationService(object):
 
             sys.exit(1)
 
+        self.scheduleBans()
+
     def reload(self):
         loader = ConfigurationLoader()
         config = loader.load(self.filename)
@@ -454,11 +1011,139 @@ class ConfigurationService(object):
         # merge()
 
         self.config = config
+        self.scheduleBans()
 
     def save(self):
-        saver + ConfigurationSaver()
+        # Replays must never touch the configuration file on disk.
+        if self.readOnly:
+            return
+
+        saver = ConfigurationSaver()
         saver.save(self.filename, self.config)
 
+    def setClock(self, clock):
+        self.clock = clock
+        self.scheduleBans()
+
+    def getClock(self):
+        return self.clock
+
+    def scheduleBans(self):
+        # Entries in the wheel are only (channel, mask) pairs which are looked
+        # up again once they fire, so a reload simply starts over with a fresh
+        # wheel rather than trying to patch up the old one.
+        self.banWheel = TimerWheel(self.banResolution, self.banSlots, self.clock.seconds())
+
+        for channel in self.config.getChannels():
+            for ban in channel.getBans():
+                self.scheduleBan(channel.getName(), ban)
+
+    def scheduleBan(self, channel, ban):
+        if ban.getExpires() is None:
+            return
+
+        # A ban which expired while we were not running is due right away,
+        # rather than a tick of the wheel from now.
+        if ban.isExpired(self.clock.seconds()):
+            if (channel, ban.getMask()) not in self.heldBans:
+                self.heldBans.append((channel, ban.getMask()))
+
+            return
+
+        self.banWheel.schedule(ban.getExpires(), (channel, ban.getMask()))
+
+    def getBanResolution(self):
+        return self.banWheel.getResolution()
+
+    def addBan(self, channel, ban):
+        c = self.config.getChannel(channel)
+
+        if c == None:
+            return False
+
+        c.addBan(ban)
+        self.scheduleBan(channel, ban)
+        self.save()
+
+        return True
+
+    def removeBan(self, channel, mask):
+        c = self.config.getChannel(channel)
+
+        if c == None:
+            return None
+
+        ban = c.removeBan(mask)
+
+        if ban is not None:
+            self.save()
+
+        return ban
+
+    def getBans(self, channel):
+        c = self.config.getChannel(channel)
+
+        if c == None:
+            return []
+
+        return c.getBans()
+
+    def getVerification(self, channel):
+        c = self.config.getChannel(channel)
+
+        if c == None:
+            return set()
+
+        return c.getVerification()
+
+    def findBan(self, hostmask, channel):
+        c = self.config.getChannel(channel)
+
+        if c == None:
+            return None
+
+        return c.findBan(hostmask.getHostmask())
+
+    def expireBans(self, now, canUnban):
+        # An expired ban stays in the configuration until canUnban(channel)
+        # says we are able to unset it on the channel. Until then it is held
+        # and tried again every time, rather than forgotten about while the
+        # +b remains in place.
+        held = self.heldBans
+        self.heldBans = []
+        r = []
+
+        for channel, mask in held + self.banWheel.advance(now):
+            c = self.config.getChannel(channel)
+
+            if c == None:
+                continue
+
+            # The ban might have been removed or replaced with a new expiry
+            # time since it was put into the wheel.
+            ban = c.getBan(mask)
+
+            if ban is None or ban.getExpires() is None:
+                continue
+
+            if not ban.isExpired(now):
+                self.scheduleBan(channel, ban)
+                continue
+
+            if not canUnban(channel):
+                if (channel, mask) not in self.heldBans:
+                    self.heldBans.append((channel, mask))
+
+                continue
+
+            c.removeBan(mask)
+            r.append((channel, ban))
+
+        if r:
+            self.save()
+
+        return r
+
     def getChannels(self):
         return self.config.getChannels()
 
@@ -471,8 +1156,24 @@ class ConfigurationService(object):
     def getRealname(self):
         return self.config.getRealname()
 
-    def findMatches(self, hostmask):
-        return self.config.userRegistry.findMatches(hostmask)
+    def getPluginDirectory(self):
+        return self.config.getPluginDirectory()
+
+    def getPluginThreads(self):
+        return self.config.getPluginThreads()
+
+    def findMatches(self, hostmask, account = None):
+        return self.config.userRegistry.findMatches(hostmask, account)
+
+    def isAdministrator(self, hostmask, account = None):
+        for user in self.findMatches(hostmask, account):
+            if user.getUserClass() == "admin":
+                return True
+
+        return False
+
+    def isSecureMask(self, mask):
+        return ConfigurationDecoder().isSecureMask(mask)
 
     def nextServer(self):
         servers = self.config.getServers()
@@ -484,13 +1185,23 @@ class ConfigurationService(object):
     def getChannelState(self, channel):
         return self.channelStates.get(channel)
 
+    def getChannelStates(self):
+        return self.channelStates.values()
+
     def joinedChannel(self, channel):
         self.channelStates[channel] = ChannelState(channel)
 
     def partedChannel(self, channel):
-        del self.channelStates[channel]
+        cs = self.channelStates.pop(channel, None)
+
+        if cs:
+            cs.cancel()
 
-    def findOperatorCandidates(self, hostmask, channel):
+    def partedAllChannels(self):
+        for channel in self.channelStates.keys():
+            self.partedChannel(channel)
+
+    def findOperatorCandidates(self, hostmask, channel, account = None):
         c = self.config.getChannel(channel)
 
         # In this case, we are currently in a channel that is not listed in our configuration file. This could possibly
@@ -502,118 +1213,1263 @@ class ConfigurationService(object):
         r = []
 
         for operator in c.getOperators():
-            if operator.match(hostmask.getHostmask()):
+            if operator.match(hostmask.getHostmask()) or operator.matchAccount(account):
                 r.append(operator)
 
         return r
 
-class Client(irc.IRCClient):
-    def _getConfig(self):
-        return self.factory.config
-
-    def _getNickname(self):
-        return self.config.getNickname()
+class Identity(object):
+    def __init__(self, nickname, account, secure):
+        self.nickname = nickname
+        self.account = account
+        self.secure = secure
+
+    def getNickname(self):
+        return self.nickname
+
+    def getAccount(self):
+        return self.account
+
+    def setAccount(self, account):
+        self.account = account
+
+    def isSecure(self):
+        return self.secure
+
+    def setSecure(self, secure):
+        self.secure = secure
+
+class IdentityService(object):
+    # Identities are cached for this many seconds, unless NICK, QUIT, PART or
+    # ACCOUNT tells us that they might have changed in the meantime.
+    ttl = 300
+
+    # Seconds to wait for an identity before giving up on it.
+    timeout = 10
+
+    # Number of WHOIS queries we have outstanding at any time. Further
+    # lookups wait in a queue, so a join flood can not get us killed for
+    # flooding the server.
+    depth = 5
+
+    def __init__(self, client):
+        self.client = client
+        self.cache = {}
+        self.pending = {}
+        self.timeouts = {}
+        self.queue = deque()
+        self.inflight = {}
+
+        # Queries which are still on their way back, but whose answer we no
+        # longer trust, since the nickname may belong to someone else by now.
+        self.discarded = set()
+
+        # Queries the server answered with ERR_NOSUCHNICK. They are not over
+        # until RPL_ENDOFWHOIS, which follows it.
+        self.missing = set()
+
+    def lookup(self, nickname):
+        key = nickname.lower()
+        entry = self.cache.get(key)
+
+        if entry is not None:
+            if entry[1] > self.client.clock.seconds():
+                return defer.succeed(entry[0])
+
+            del self.cache[key]
+
+        d = defer.Deferred()
+
+        # Somebody joining several of our channels at once only costs us a
+        # single query.
+        if key in self.pending:
+            self.pending[key].append(d)
+            return d
+
+        self.pending[key] = [d]
+        self.timeouts[key] = self.client.clock.callLater(self.timeout, self.timedOut, key)
+        self.queue.append(nickname)
+        self.next()
+
+        return d
+
+    def next(self):
+        waiting = deque()
+
+        while self.queue and len(self.inflight) < self.depth:
+            nickname = self.queue.popleft()
+            key = nickname.lower()
+
+            # Replies carry nothing but the nickname, so we can only have a
+            # single query per nickname outstanding.
+            if key in self.inflight:
+                waiting.append(nickname)
+                continue
+
+            self.inflight[key] = Identity(nickname, None, False)
+            self.client.whois(nickname)
+
+        waiting.extend(self.queue)
+        self.queue = waiting
+
+    def getReply(self, nickname):
+        key = nickname.lower()
+
+        if key in self.discarded or key in self.missing:
+            return None
+
+        return self.inflight.get(key)
+
+    def notFound(self, nickname):
+        key = nickname.lower()
+
+        if key in self.inflight and key not in self.discarded:
+            self.missing.add(key)
+
+    def finished(self, nickname):
+        key = nickname.lower()
+        identity = self.inflight.pop(key, None)
+
+        # Not one of ours, or one we already gave up on.
+        if identity is None:
+            return
+
+        found = key not in self.missing
+        self.missing.discard(key)
+
+        if key in self.discarded:
+            self.discarded.discard(key)
+            self.next()
+            return
+
+        if found:
+            self.cache[key] = (identity, self.client.clock.seconds() + self.ttl)
+
+        self.resolve(key, identity)
+        self.next()
+
+    def resolve(self, key, identity):
+        call = self.timeouts.pop(key, None)
+
+        if call is not None and call.active():
+            call.cancel()
+
+        for d in self.pending.pop(key, []):
+            d.callback(identity)
+
+    def timedOut(self, key):
+        del self.timeouts[key]
+
+        self.queue = deque([nickname for nickname in self.queue if nickname.lower() != key])
+        self.inflight.pop(key, None)
+        self.missing.discard(key)
+
+        for d in self.pending.pop(key, []):
+            d.errback(defer.TimeoutError("No identity for '%s' within %d seconds" % (key, self.timeout)))
+
+        self.next()
+
+    def invalidate(self, nickname):
+        self.cache.pop(nickname.lower(), None)
+
+    def cancel(self, nickname):
+        # Whatever we find out about this nickname from now on might be about
+        # someone else, so fail everybody who is waiting for it.
+        key = nickname.lower()
+        self.invalidate(nickname)
+
+        if key not in self.pending:
+            return
+
+        call = self.timeouts.pop(key)
+
+        if call.active():
+            call.cancel()
+
+        self.queue = deque([n for n in self.queue if n.lower() != key])
+
+        if key in self.inflight:
+            self.discarded.add(key)
+            self.missing.discard(key)
+
+        for d in self.pending.pop(key):
+            d.errback(defer.CancelledError("Lookup of '%s' was cancelled" % nickname))
+
+    def stop(self):
+        # The connection is gone; fail everything that is still waiting.
+        self.queue.clear()
+        self.inflight = {}
+        self.discarded = set()
+        self.missing = set()
+
+        for key in self.pending.keys():
+            self.timeouts[key].cancel()
+            self.timedOut(key)
+
+        self.cache = {}
+
+class Event(object):
+    # Plugins receive events through methods named event_<name>, in the same
+    # way commands are dispatched to cmd_<name> methods on the Client.
+    name = None
+
+    def __init__(self, client):
+        self.client = client
+
+    def getName(self):
+        return self.name
+
+    def getClient(self):
+        return self.client
+
+class JoinEvent(Event):
+    name = "join"
+
+    def __init__(self, client, hostmask, channel):
+        Event.__init__(self, client)
+        self.hostmask = hostmask
+        self.channel = channel
+
+    def getHostmask(self):
+        return self.hostmask
+
+    def getChannel(self):
+        return self.channel
+
+class PartEvent(Event):
+    name = "part"
+
+    def __init__(self, client, hostmask, channel, reason):
+        Event.__init__(self, client)
+        self.hostmask = hostmask
+        self.channel = channel
+        self.reason = reason
+
+    def getHostmask(self):
+        return self.hostmask
+
+    def getChannel(self):
+        return self.channel
+
+    def getReason(self):
+        return self.reason
+
+class ModeEvent(Event):
+    name = "mode"
+
+    def __init__(self, client, user, channel, added, modes, args):
+        Event.__init__(self, client)
+        self.user = user
+        self.channel = channel
+        self.added = added
+        self.modes = modes
+        self.args = args
+
+    def getUser(self):
+        return self.user
+
+    def getChannel(self):
+        return self.channel
+
+    def isAdded(self):
+        return self.added
+
+    def getModes(self):
+        return self.modes
+
+    def getArgs(self):
+        return self.args
+
+class PrivmsgEvent(Event):
+    name = "privmsg"
+
+    def __init__(self, client, hostmask, target, message):
+        Event.__init__(self, client)
+        self.hostmask = hostmask
+        self.target = target
+        self.message = message
+
+    def getHostmask(self):
+        return self.hostmask
+
+    def getTarget(self):
+        return self.target
+
+    def getMessage(self):
+        return self.message
+
+class CtcpEvent(Event):
+    name = "ctcp"
+
+    def __init__(self, client, hostmask, target, tag, data):
+        Event.__init__(self, client)
+        self.hostmask = hostmask
+        self.target = target
+        self.tag = tag
+        self.data = data
+
+    def getHostmask(self):
+        return self.hostmask
+
+    def getTarget(self):
+        return self.target
+
+    def getTag(self):
+        return self.tag
+
+    def getData(self):
+        return self.data
+
+class PluginRunner(object):
+    # Plugins can override these by setting attributes of the same name on
+    # their Plugin class.
+    threaded = False
+    budget = 0.1
+    queueSize = 64
+
+    def __init__(self, name, plugin, bus):
+        self.name = name
+        self.plugin = plugin
+        self.bus = bus
+        self.threaded = getattr(plugin, "threaded", self.threaded)
+        self.budget = getattr(plugin, "budget", self.budget)
+        self.queueSize = getattr(plugin, "queueSize", self.queueSize)
+
+        # Threaded plugins get at most one handler running on the pool at any
+        # time; everything else waits in a bounded queue, so one slow plugin
+        # can neither starve the others of threads nor eat all our memory.
+        self.queue = deque()
+        self.running = False
+
+        # Statistics.
+        self.processed = 0
+        self.dropped = 0
+        self.failed = 0
+        self.slow = 0
+
+    def getName(self):
+        return self.name
+
+    def isThreaded(self):
+        return self.threaded
+
+    def getStatistics(self):
+        return (self.processed, self.dropped, self.failed, self.slow)
+
+    def dispatch(self, event):
+        handler = getattr(self.plugin, "event_%s" % event.getName(), None)
+
+        if handler is None:
+            return
+
+        if not self.threaded or self.bus.isInline():
+            self.run(handler, event)
+            return
+
+        if len(self.queue) >= self.queueSize:
+            self.dropped += 1
+
+            # Only complain once in a while, a flood would otherwise turn
+            # into a flood of log lines as well.
+            if self.dropped & (self.dropped - 1) == 0:
+                print ">>> Plugin '%s' is not keeping up, dropped %d event(s) so far" % (self.name, self.dropped)
+
+            return
+
+        self.queue.append((handler, event))
+        self.next()
+
+    def next(self):
+        if self.running or not self.queue:
+            return
+
+        handler, event = self.queue.popleft()
+        self.running = True
+
+        d = threads.deferToThreadPool(reactor, self.bus.getPool(), self.run, handler, event)
+        d.addBoth(self.finished)
+
+    def finished(self, result):
+        self.running = False
+        self.next()
+
+    def run(self, handler, event):
+        start = time.time()
+
+        try:
+            handler(event)
+        except Exception:
+            self.failed += 1
+            print ">>> Plugin '%s' failed handling %s event:" % (self.name, event.getName())
+            traceback.print_exc()
+
+        elapsed = time.time() - start
+        self.processed += 1
+
+        if elapsed > self.budget:
+            self.slow += 1
+            print ">>> Plugin '%s' spent %.3fs handling %s event (budget: %.3fs)" % (self.name, elapsed, event.getName(), self.budget)
+
+class EventBus(object):
+    def __init__(self, threads):
+        self.threads = threads
+        self.runners = []
+        self.pool = None
+        self.inline = False
+
+    def load(self, directory):
+        # Every Python file in the plugin directory is expected to define a
+        # Plugin class, which we instantiate without any arguments.
+        for filename in sorted(os.listdir(directory)):
+            if not filename.endswith(".py") or filename.startswith("_"):
+                continue
+
+            name = filename[:-3]
+
+            try:
+                module = imp.load_source("plugin_%s" % name, os.path.join(directory, filename))
+                plugin = module.Plugin()
+            except Exception:
+                print ">>> Unable to load plugin '%s':" % name
+                traceback.print_exc()
+                continue
+
+            runner = PluginRunner(name, plugin, self)
+            self.runners.append(runner)
+
+            if runner.isThreaded():
+                print ">>> Loaded plugin '%s' (threaded)" % name
+            else:
+                print ">>> Loaded plugin '%s' (inline)" % name
+
+    def getRunners(self):
+        return self.runners
+
+    def setInline(self, inline):
+        # Runs threaded plugins inline as well, for when there is no reactor
+        # running to hand their results back to.
+        self.inline = inline
+
+    def isInline(self):
+        return self.inline
+
+    def getPool(self):
+        if self.pool is None:
+            self.pool = ThreadPool(0, self.threads, "plugins")
+            self.pool.start()
+            reactor.addSystemEventTrigger("before", "shutdown", self.stop)
+
+        return self.pool
+
+    def stop(self):
+        if self.pool is not None:
+            self.pool.stop()
+            self.pool = None
+
+    def publish(self, event):
+        for runner in self.runners:
+            runner.dispatch(event)
+
+class CaptureWriter(object):
+    # Python 2 has no time.monotonic(); fall back to the wall clock there.
+    clock = staticmethod(getattr(time, "monotonic", time.time))
+
+    # How often, in seconds, the compressed stream is flushed to disk.
+    flushInterval = 5.0
+
+    def __init__(self, filename):
+        self.file = gzip.open(filename, "wb")
+        self.start = self.clock()
+        self.lastFlush = self.start
+
+    def record(self, direction, line):
+        # One record per line: the number of seconds since the capture was
+        # started, the direction ('<' inbound, '>' outbound and '*' for
+        # connection events) and the raw line itself.
+        now = self.clock()
+        self.file.write("%.6f %s %s\n" % (now - self.start, direction, line))
+
+        if now - self.lastFlush >= self.flushInterval:
+            self.file.flush()
+            self.lastFlush = now
+
+    def close(self):
+        self.file.close()
+
+class CaptureBuffer(object):
+    def __init__(self):
+        self.records = []
+
+    def record(self, direction, line):
+        self.records.append((direction, line))
+
+    def getLines(self, direction):
+        return [record[1] for record in self.records if record[0] == direction]
+
+class CaptureReader(object):
+    def __init__(self, filename):
+        self.filename = filename
+
+    def __iter__(self):
+        f = gzip.open(self.filename, "rb")
+
+        try:
+            while True:
+                # A bot which did not shut down cleanly, because it crashed or
+                # was killed, leaves a capture without the gzip trailer and
+                # possibly with half a record at the end. Everything up to
+                # that point is still good.
+                try:
+                    record = f.readline()
+                except (IOError, EOFError) as e:
+                    print ">>> Capture '%s' is truncated (%s); using the records read so far" % (self.filename, e)
+                    break
+
+                if not record:
+                    break
+
+                if not record.endswith("\n"):
+                    print ">>> Capture '%s' ends with an incomplete record; ignoring it" % self.filename
+                    break
+
+                tmp = record.rstrip("\n").split(" ", 2)
+
+                if len(tmp) == 2:
+                    tmp.append("")
+
+                yield (float(tmp[0]), tmp[1], tmp[2])
+        finally:
+            f.close()
+
+class Client(irc.IRCClient):
+    def _getConfig(self):
+        return self.factory.config
+
+    def _getEventBus(self):
+        return self.factory.eventBus
+
+    def _getNickname(self):
+        return self.config.getNickname()
 
     def _getUsername(self):
         return self.config.getUsername()
 
-    def _getRealname(self):
-        return self.config.getRealname()
+    def _getRealname(self):
+        return self.config.getRealname()
+
+    config = property(_getConfig)
+    eventBus = property(_getEventBus)
+    nickname = property(_getNickname)
+    username = property(_getUsername)
+    realname = property(_getRealname)
+
+    # Bans and kicks triggered within this many seconds of each other are sent
+    # together, which is what makes a join flood of clones cheap to deal with.
+    banDelay = 0.5
+
+    # Everything time related goes through the clock, such that a replay can
+    # run the client against a task.Clock instead of the real reactor.
+    clock = reactor
+
+    # Bans and kicks beyond the first floodBurst lines go out floodDelay
+    # seconds apart, lest the server disconnects us for Excess Flood in the
+    # middle of a join flood.
+    floodBurst = 5
+    floodDelay = 1.0
+
+    # IRCv3 capabilities we ask for whenever the server offers them. Together
+    # they keep the roster accurate without having to poll with WHO.
+    wantedCapabilities = set([
+        "multi-prefix",
+        "extended-join",
+        "account-notify",
+        "away-notify",
+        "chghost",
+        "userhost-in-names"
+    ])
+
+    expiryCall = None
+    pacedCall = None
+    capture = None
+
+    def alterCollidedNick(self, nickname):
+        return nickname + "_"
+
+    def connectionMade(self):
+        self.capture = self.factory.capture
+        self.capabilities = set()
+        self.offeredCapabilities = set()
+        self.negotiating = False
+        self.roster = Roster()
+        self.identities = IdentityService(self)
+        self.pacedLines = deque()
+        self.pacedCredit = self.floodBurst
+        self.pacedTime = self.clock.seconds()
+
+        if self.capture is not None:
+            # The time of day lets a replay put its clock, and thereby ban
+            # expiry, where it was when the capture was taken.
+            self.capture.record("*", "connect %.6f" % self.clock.seconds())
+
+        irc.IRCClient.connectionMade(self)
+
+    def register(self, nickname, hostname = "foo", servername = "bar"):
+        # Servers that know about CAP hold back our registration until we send
+        # CAP END, everybody else will simply ignore the command.
+        self.negotiating = True
+        self.sendLine("CAP LS 302")
+        irc.IRCClient.register(self, nickname, hostname, servername)
+
+    def hasCapability(self, capability):
+        return capability in self.capabilities
+
+    def requestCapabilities(self, offered):
+        wanted = sorted(self.wantedCapabilities.intersection(offered).difference(self.capabilities))
+
+        if wanted:
+            self.sendLine("CAP REQ :%s" % " ".join(wanted))
+        else:
+            self.endCapabilityNegotiation()
+
+    def endCapabilityNegotiation(self):
+        if self.negotiating:
+            self.negotiating = False
+            self.sendLine("CAP END")
+
+    def irc_protocol_CAP(self, prefix, command, params):
+        if len(params) < 3:
+            return
+
+        subcommand = params[1]
+        capabilities = [capability.split("=", 1)[0] for capability in params[-1].split()]
+
+        if subcommand == "LS":
+            self.offeredCapabilities.update(capabilities)
+
+            # A '*' in front of the list means that more lines will follow.
+            if len(params) > 3 and params[2] == "*":
+                return
+
+            self.requestCapabilities(self.offeredCapabilities)
+        elif subcommand == "NEW":
+            self.offeredCapabilities.update(capabilities)
+            self.requestCapabilities(capabilities)
+        elif subcommand == "DEL":
+            self.offeredCapabilities.difference_update(capabilities)
+            self.capabilities.difference_update(capabilities)
+        elif subcommand == "ACK":
+            for capability in capabilities:
+                if capability.startswith("-"):
+                    self.capabilities.discard(capability[1:])
+                else:
+                    self.capabilities.add(capability)
+
+            print ">>> Enabled capabilities: %s" % ", ".join(sorted(self.capabilities))
+            self.endCapabilityNegotiation()
+        elif subcommand == "NAK":
+            print ">>> Server refused capabilities: %s" % ", ".join(capabilities)
+            self.endCapabilityNegotiation()
+
+    def lineReceived(self, line):
+        if self.capture is not None:
+            self.capture.record("<", line)
+
+        irc.IRCClient.lineReceived(self, line)
+
+    def sendLine(self, line):
+        if self.capture is not None:
+            self.capture.record(">", line)
+
+        irc.IRCClient.sendLine(self, line)
+
+    def sendPaced(self, line):
+        self.pacedLines.append(line)
+
+        if self.pacedCall is None:
+            self.sendPacedLines()
+
+    def sendPacedLines(self):
+        self.pacedCall = None
+
+        # The allowance builds up again while we are quiet.
+        now = self.clock.seconds()
+        self.pacedCredit = min(self.floodBurst, self.pacedCredit + (now - self.pacedTime) / self.floodDelay)
+        self.pacedTime = now
+
+        while self.pacedLines and self.pacedCredit >= 1:
+            self.sendLine(self.pacedLines.popleft())
+            self.pacedCredit -= 1
+
+        if self.pacedLines:
+            self.pacedCall = self.clock.callLater((1 - self.pacedCredit) * self.floodDelay, self.sendPacedLines)
+
+    def getMaximumLineLength(self):
+        # Servers cut lines at 512 bytes including CR-LF, and the lines they
+        # relay to others start with our hostmask, so leave room for the
+        # longest one we could have.
+        return irc.MAX_COMMAND_LENGTH - 2 - len(":%s!%s@%s " % (self.nickname, "u" * 10, "h" * 63))
+
+    def splitArguments(self, arguments, limit, room, size = len):
+        # Splits arguments into chunks of at most limit arguments, or any
+        # number if limit is None, whose sizes add up to at most room.
+        chunks = []
+        chunk = []
+        used = 0
+
+        for argument in arguments:
+            if chunk and ((limit and len(chunk) >= limit) or used + size(argument) > room):
+                chunks.append(chunk)
+                chunk = []
+                used = 0
+
+            chunk.append(argument)
+            used += size(argument)
+
+        if chunk:
+            chunks.append(chunk)
+
+        return chunks
+
+    def signedOn(self):
+        print ">>> Signed On"
+
+        self.expiryCall = task.LoopingCall(self.expireBans)
+        self.expiryCall.clock = self.clock
+        self.expiryCall.start(self.config.getBanResolution(), now = True)
+
+        for channel in self.config.getChannels():
+            self.join(channel.getName())
+
+    def connectionLost(self, reason):
+        if self.expiryCall is not None and self.expiryCall.running:
+            self.expiryCall.stop()
+
+        self.identities.stop()
+
+        if self.pacedCall is not None and self.pacedCall.active():
+            self.pacedCall.cancel()
+
+        self.pacedCall = None
+        self.pacedLines.clear()
+
+        self.config.partedAllChannels()
+
+        irc.IRCClient.connectionLost(self, reason)
+
+    def joined(self, channel):
+        print ">>> Joining: %s" % channel
+        self.config.joinedChannel(channel)
+
+    def userJoined(self, user, channel):
+        print ">>> %s has joined %s" % (user, channel)
+
+    def privmsg(self, user, target, message):
+        hostmask = Hostmask.parse(user)
+
+        if hostmask is None:
+            return
+
+        self.eventBus.publish(PrivmsgEvent(self, hostmask, target, message))
+
+        if self.nickname != target:
+            return
+
+        print ">>> Message from '%s': '%s'" % (hostmask.getHostmask(), message)
+
+        parameters = message.split(" ")
+        length = len(parameters)
+
+        if length >= 1:
+            method = getattr(self, "cmd_%s" % parameters[0], None)
+
+            if method:
+                print ">>> Executing handler for command '%s'" % parameters[0]
+                method(hostmask, parameters)
+            else:
+                self.notice(hostmask.getNickname(), "Unknown Command: %s" % message)
+
+    def irc_JOIN(self, prefix, params):
+        if len(params) < 1:
+            return
+
+        hostmask = Hostmask.parse(prefix)
+
+        if hostmask is None:
+            return
+
+        channel = params[0]
+        nickname = hostmask.getNickname()
+
+        # Default implementation from Twisted:
+        if nickname == self.nickname:
+            self.joined(channel)
+            self.addMember(hostmask, channel)
+        else:
+            member = self.addMember(hostmask, channel)
+
+            # With extended-join the services account, or '*' if there is
+            # none, comes along with the JOIN itself.
+            if self.hasCapability("extended-join") and len(params) >= 2:
+                member.setAccount(self.parseAccount(params[1]))
+
+            self.userJoined(nickname, channel)
+
+            if not self.considerBanning(hostmask, channel):
+                self.considerOpping(hostmask, channel)
+
+            self.eventBus.publish(JoinEvent(self, hostmask, channel))
+
+    def irc_PART(self, prefix, params):
+        if len(params) < 1:
+            return
+
+        hostmask = Hostmask.parse(prefix)
+
+        if hostmask is None:
+            return
+
+        channel = params[0]
+        nickname = hostmask.getNickname()
+
+        if len(params) > 1:
+            reason = params[1]
+        else:
+            reason = None
+
+        # Default implementation from Twisted:
+        if nickname == self.nickname:
+            self.left(channel)
+        else:
+            self.removeMember(nickname, channel)
+            self.userLeft(nickname, channel)
+            self.eventBus.publish(PartEvent(self, hostmask, channel, reason))
+
+    def op(self, channel, nick):
+        self.mode(channel, True, "o", user = nick)
+
+    def queueBan(self, channel, mask, nick = None, reason = None):
+        cs = self.config.getChannelState(channel)
+
+        if not cs:
+            return
+
+        if mask not in cs.getBans():
+            cs.queueMode("+", "b", mask)
+
+        if nick is not None:
+            cs.queueKick(nick, reason)
+
+        self.scheduleFlush(cs)
+
+    def queueUnban(self, channel, mask):
+        cs = self.config.getChannelState(channel)
+
+        if not cs:
+            return
+
+        cs.queueMode("-", "b", mask)
+        self.scheduleFlush(cs)
+
+    def scheduleFlush(self, cs):
+        if cs.flushCall is None or not cs.flushCall.active():
+            cs.flushCall = self.clock.callLater(self.banDelay, self.flushChannel, cs.getName())
+
+    def flushChannel(self, channel):
+        cs = self.config.getChannelState(channel)
+
+        if not cs:
+            return
+
+        cs.flushCall = None
+
+        # We may have lost op between queueing and flushing.
+        if not cs.isOpped():
+            cs.takePendingModes()
+            cs.takePendingKicks()
+            return
+
+        self.sendModes(channel, cs.takePendingModes())
+        self.sendKicks(channel, cs.takePendingKicks())
+
+    def sendModes(self, channel, modes):
+        if not modes:
+            return
+
+        # MODES= from ISUPPORT tells us how many modes with a parameter the
+        # server accepts per MODE command. No value means no limit, other than
+        # the length of the line. Every mode costs its letter, a space and its
+        # argument, plus a sign in the worst case.
+        limit = self.supported.getFeature("MODES")
+        room = self.getMaximumLineLength() - len("MODE %s " % channel)
+
+        for chunk in self.splitArguments(modes, limit, room, lambda mode: len(mode[2]) + 3):
+            modeString = ""
+            sign = None
+
+            for mode in chunk:
+                if mode[0] != sign:
+                    sign = mode[0]
+                    modeString += sign
+
+                modeString += mode[1]
+
+            self.sendPaced("MODE %s %s %s" % (channel, modeString, " ".join([mode[2] for mode in chunk])))
+
+    def sendKicks(self, channel, kicks):
+        # Kicks are grouped by reason, since a KICK command only carries a
+        # single reason, and split according to TARGMAX=KICK:n. Servers that
+        # do not advertise TARGMAX get a single target per KICK command.
+        targmax = self.supported.getFeature("TARGMAX") or {}
+        reasons = []
+        nicks = {}
+
+        for nick, reason in kicks:
+            if reason not in nicks:
+                reasons.append(reason)
+                nicks[reason] = []
+
+            nicks[reason].append(nick)
+
+        # TARGMAX=KICK: without a number means no limit, other than the length
+        # of the line. Every target costs its nickname and a comma.
+        limit = targmax.get("KICK", 1)
+
+        for reason in reasons:
+            room = self.getMaximumLineLength() - len("KICK %s  :%s" % (channel, reason))
+
+            for chunk in self.splitArguments(nicks[reason], limit, room, lambda nick: len(nick) + 1):
+                self.sendPaced("KICK %s %s :%s" % (channel, ",".join(chunk), reason))
+
+    def expireBans(self):
+        for channel, ban in self.config.expireBans(self.clock.seconds(), self.isOpped):
+            print ">>> Ban on %s for '%s' expired" % (channel, ban.getMask())
+            self.queueUnban(channel, ban.getMask())
+
+    def isOpped(self, channel):
+        cs = self.config.getChannelState(channel)
+
+        return cs is not None and cs.isOpped()
+
+    def who(self, target):
+        self.sendLine("WHO %s" % target)
+
+    def ctcpQuery(self, user, channel, messages):
+        hostmask = Hostmask.parse(user)
+
+        if hostmask is not None:
+            for tag, data in messages:
+                self.eventBus.publish(CtcpEvent(self, hostmask, channel, tag, data))
+
+        irc.IRCClient.ctcpQuery(self, user, channel, messages)
+
+    def ctcpUnknownQuery(self, user, channel, tag, data):
+        # Ignore unknown CTCP messages.
+        pass
+
+    def irc_unknown(self, prefix, command, params):
+        method = getattr(self, "irc_protocol_%s" % command, None)
+
+        if method:
+            method(prefix, command, params)
+
+    def ctcpQuery_OP(self, user, target, message):
+        if target != self.nickname:
+            return
+
+        if message is None:
+            return
+
+        hostmask = Hostmask.parse(user)
+
+        if hostmask is None:
+            return
+
+        channels = message.split(" ")
+        message = ", ".join(channels)
+
+        print ">>> CTCP OP from '%s' for channels: %s" % (hostmask.getHostmask(), message)
+
+        for channel in channels:
+            self.considerOpping(hostmask, channel)
+
+    def parseAccount(self, account):
+        if account == "*":
+            return None
+
+        return account
+
+    def getAccount(self, nickname):
+        member = self.roster.find(nickname)
+
+        if member is None:
+            return None
+
+        return member.getAccount()
+
+    def addMember(self, hostmask, channel, modes = ()):
+        member = self.roster.update(hostmask)
+        cs = self.config.getChannelState(channel)
+
+        if cs:
+            cs.addMember(hostmask.getNickname(), modes)
+
+        return member
+
+    def removeMember(self, nickname, channel):
+        cs = self.config.getChannelState(channel)
+
+        if cs:
+            cs.removeMember(nickname)
+
+        self.identities.cancel(nickname)
+        self.forgetMember(nickname)
+
+    def forgetMember(self, nickname):
+        # Only forget about people once we no longer share any channels.
+        for cs in self.config.getChannelStates():
+            if cs.hasMember(nickname):
+                return
+
+        self.roster.remove(nickname)
+        self.identities.invalidate(nickname)
+
+    def splitPrefixes(self, name):
+        # Returns the prefix modes and whatever follows the prefixes. With
+        # multi-prefix there may be more than one prefix per name.
+        prefixes = self.supported.getFeature("PREFIX") or {}
+        modes = {}
+
+        for mode, (prefix, priority) in prefixes.items():
+            modes[prefix] = mode
+
+        r = set()
+        i = 0
+
+        while i < len(name) and name[i] in modes:
+            r.add(modes[name[i]])
+            i += 1
+
+        return r, name[i:]
+
+    def reconsiderMember(self, member):
+        # Called when something we match users on, their hostmask or their
+        # services account, changes while they are in our channels.
+        hostmask = member.getHostmask()
+
+        if hostmask is None:
+            return
+
+        for cs in self.config.getChannelStates():
+            channel = cs.getName()
+
+            if not cs.hasMember(member.getNickname()):
+                continue
+
+            if cs.hasMemberMode(member.getNickname(), "o"):
+                continue
+
+            if not self.considerBanning(hostmask, channel):
+                self.considerOpping(hostmask, channel)
+
+    def irc_protocol_RPL_NAMREPLY(self, prefix, command, params):
+        if len(params) < 4:
+            return
+
+        cs = self.config.getChannelState(params[2])
+
+        if not cs:
+            return
+
+        for name in params[3].split():
+            modes, name = self.splitPrefixes(name)
+
+            # With userhost-in-names we get the full hostmask right away.
+            hostmask = Hostmask.parse(name)
 
-    config = property(_getConfig)
-    nickname = property(_getNickname)
-    username = property(_getUsername)
-    realname = property(_getRealname)
+            if hostmask is None:
+                self.roster.get(name)
+                cs.setMemberModes(name, modes)
+            else:
+                self.roster.update(hostmask)
+                cs.setMemberModes(hostmask.getNickname(), modes)
 
-    def alterCollidedNick(self, nickname):
-        return nickname + "_"
+    def irc_protocol_RPL_ENDOFNAMES(self, prefix, command, params):
+        if len(params) < 2:
+            return
 
-    def signedOn(self):
-        print ">>> Signed On"
+        channel = params[1]
+        cs = self.config.getChannelState(channel)
 
-        for channel in self.config.getChannels():
-            self.join(channel.getName())
+        if not cs:
+            return
 
-    def joined(self, channel):
-        print ">>> Joining: %s" % channel
-        self.config.joinedChannel(channel)
+        # Without userhost-in-names we have to ask for the hostmasks.
+        for nickname in cs.getMembers():
+            if self.roster.get(nickname).getHostmask() is None:
+                self.who(channel)
+                return
 
-    def userJoined(self, user, channel):
-        print ">>> %s has joined %s" % (user, channel)
+        print ">>> Synchronized %s (%d members)" % (channel, len(cs.getMembers()))
 
-    def privmsg(self, user, target, message):
-        if self.nickname != target:
+    def irc_protocol_RPL_WHOREPLY(self, prefix, command, params):
+        if len(params) < 7:
             return
 
-        hostmask = Hostmask.parse(user)
+        channel = params[1]
+        nickname = params[5]
+        flags = params[6]
 
-        if hostmask is None:
-            return
+        member = self.roster.find(nickname)
 
-        print ">>> Message from '%s': '%s'" % (hostmask.getHostmask(), message)
+        if member is None:
+            return
 
-        parameters = message.split(" ")
-        length = len(parameters)
+        member.setUserhost(params[2], params[3])
+        member.setAway(flags.startswith("G"))
 
-        if length >= 1:
-            method = getattr(self, "cmd_%s" % parameters[0], None)
+        cs = self.config.getChannelState(channel)
 
-            if method:
-                print ">>> Executing handler for command '%s'" % parameters[0]
-                method(hostmask, parameters)
-            else:
-                self.notice(hostmask.getNickname(), "Unknown Command: %s" % message)
+        if cs and cs.hasMember(nickname):
+            # The flags are H or G, optionally followed by '*' for IRC
+            # operators, and then the channel prefixes.
+            modes = self.splitPrefixes(flags[1:].lstrip("*"))[0]
+            cs.setMemberModes(nickname, modes)
 
-    def irc_JOIN(self, prefix, params):
-        if len(params) != 1:
+    def irc_protocol_RPL_ENDOFWHO(self, prefix, command, params):
+        if len(params) < 2:
             return
 
+        cs = self.config.getChannelState(params[1])
+
+        if cs:
+            print ">>> Synchronized %s (%d members)" % (params[1], len(cs.getMembers()))
+
+    def irc_protocol_ACCOUNT(self, prefix, command, params):
         hostmask = Hostmask.parse(prefix)
-        channel = params[0]
-        nickname = hostmask.getNickname()
 
-        # Default implementation from Twisted:
-        if nickname == self.nickname:
-            self.joined(channel)
-        else:
-            self.userJoined(nickname, channel)
-            self.considerOpping(hostmask, channel)
+        if hostmask is None or len(params) < 1:
+            return
 
-    def op(self, channel, nick):
-        self.mode(channel, True, "o", user = nick)
+        member = self.roster.update(hostmask)
+        member.setAccount(self.parseAccount(params[0]))
+        self.identities.invalidate(hostmask.getNickname())
 
-    def who(self, target):
-        self.sendLine("WHO %s" % target)
+        print ">>> %s is now logged in as: %s" % (hostmask.getNickname(), member.getAccount())
+        self.reconsiderMember(member)
 
-    def ctcpUnknownQuery(self, user, channel, tag, data):
-        # Ignore unknown CTCP messages.
-        pass
+    def irc_protocol_RPL_WHOISUSER(self, prefix, command, params):
+        if len(params) < 4:
+            return
 
-    def irc_unknown(self, prefix, command, params):
-        method = getattr(self, "irc_protocol_%s" % command, None)
+        member = self.roster.find(params[1])
 
-        if method:
-            method(prefix, command, params)
+        if member is not None:
+            member.setUserhost(params[2], params[3])
 
-    def ctcpQuery_OP(self, user, target, message):
-        if target != self.nickname:
+    def irc_protocol_330(self, prefix, command, params):
+        # RPL_WHOISACCOUNT: <me> <nickname> <account> :is logged in as
+        if len(params) < 3:
             return
 
-        if message is None:
+        identity = self.identities.getReply(params[1])
+
+        if identity is not None:
+            identity.setAccount(params[2])
+
+    def irc_protocol_671(self, prefix, command, params):
+        # RPL_WHOISSECURE: <me> <nickname> :is using a secure connection
+        if len(params) < 2:
             return
 
-        hostmask = Hostmask.parse(user)
+        identity = self.identities.getReply(params[1])
+
+        if identity is not None:
+            identity.setSecure(True)
+
+    def irc_protocol_RPL_ENDOFWHOIS(self, prefix, command, params):
+        if len(params) < 2:
+            return
+
+        identity = self.identities.getReply(params[1])
+
+        # Without account-notify, WHOIS is how we learn about accounts.
+        if identity is not None:
+            member = self.roster.find(params[1])
+
+            if member is not None:
+                member.setAccount(identity.getAccount())
+
+        self.identities.finished(params[1])
+
+    def irc_protocol_ERR_NOSUCHNICK(self, prefix, command, params):
+        # The RPL_ENDOFWHOIS that follows is what ends the query; answering it
+        # here would let it end the next query for the nickname as well.
+        if len(params) < 2:
+            return
+
+        self.identities.notFound(params[1])
+
+    def lookupIdentity(self, nickname, verification):
+        # When the server tells us about accounts through extended-join and
+        # account-notify, the roster is as good as a WHOIS, unless we need
+        # to know about the connection as well.
+        if verification == set(["account"]) and self.hasCapability("account-notify"):
+            member = self.roster.find(nickname)
+
+            if member is not None and member.isAccountKnown():
+                return defer.succeed(Identity(nickname, member.getAccount(), None))
+
+        return self.identities.lookup(nickname)
+
+    def irc_protocol_AWAY(self, prefix, command, params):
+        hostmask = Hostmask.parse(prefix)
 
         if hostmask is None:
             return
 
-        channels = message.split(" ")
-        message = ", ".join(channels)
+        member = self.roster.find(hostmask.getNickname())
 
-        print ">>> CTCP OP from '%s' for channels: %s" % (hostmask.getHostmask(), message)
+        if member is not None:
+            member.setAway(len(params) > 0 and params[0] != "")
 
-        for channel in channels:
-            self.considerOpping(hostmask, channel)
+    def irc_protocol_CHGHOST(self, prefix, command, params):
+        hostmask = Hostmask.parse(prefix)
+
+        if hostmask is None or len(params) < 2:
+            return
+
+        member = self.roster.find(hostmask.getNickname())
+
+        if member is None:
+            return
+
+        member.setUserhost(params[0], params[1])
+
+        print ">>> %s changed host to: %s@%s" % (hostmask.getNickname(), params[0], params[1])
+        self.reconsiderMember(member)
+
+    def considerBanning(self, hostmask, channel):
+        ban = self.config.findBan(hostmask, channel)
+
+        if ban is None:
+            return False
+
+        # Never kick out one of our own operators, even if they happen to be
+        # caught by a broad ban.
+        if self.config.findOperatorCandidates(hostmask, channel, self.getAccount(hostmask.getNickname())):
+            print ">>> Not banning operator %s on %s despite ban '%s'" % (hostmask.getNickname(), channel, ban.getMask())
+            return False
+
+        cs = self.config.getChannelState(channel)
+
+        # A banned user is never opped, even if we are unable to ban them.
+        if not cs or not cs.isOpped():
+            return True
+
+        print ">>> Banning %s on %s: '%s' matched ban '%s'" % (hostmask.getNickname(), channel, hostmask.getHostmask(), ban.getMask())
+        self.queueBan(channel, ban.getMask(), hostmask.getNickname(), ban.getReason())
+
+        return True
 
     def considerOpping(self, hostmask, channel):
         cs = self.config.getChannelState(channel)
@@ -624,18 +2480,82 @@ class Client(irc.IRCClient):
         if not cs.isOpped():
             return
 
-        print ">>> Considering giving op to %s on %s" % (hostmask.getNickname(), channel)
-        matches = self.config.findOperatorCandidates(hostmask, channel)
-
         nick = hostmask.getNickname()
+
+        # No need to op someone who is already opped.
+        if cs.hasMemberMode(nick, "o"):
+            return
+
+        print ">>> Considering giving op to %s on %s" % (nick, channel)
+        account = self.getAccount(nick)
+        matches = self.config.findOperatorCandidates(hostmask, channel, account)
+
         op = False
 
         for match in matches:
-            print ">>> Found match for %s: '%s' matched '%s' for bot user '%s'" % (nick, hostmask.getHostmask(), match.getMask(), match.getName())
+            if match.matchAccount(account):
+                print ">>> Found match for %s: account '%s' for bot user '%s'" % (nick, account, match.getName())
+            else:
+                print ">>> Found match for %s: '%s' matched '%s' for bot user '%s'" % (nick, hostmask.getHostmask(), match.getMask(), match.getName())
+
             op = True
 
-        if op:
+        if not op:
+            return
+
+        verification = self.config.getVerification(channel)
+
+        if not verification:
+            self.op(channel, nick)
+            return
+
+        # Operators without an account can never pass an account check, so
+        # there is no point in looking them up.
+        if "account" in verification and not [match for match in matches if match.getAccount() is not None]:
+            print ">>> Not verifying %s on %s, since no matching bot user has an account" % (nick, channel)
+            return
+
+        print ">>> Verifying identity of %s before opping on %s" % (nick, channel)
+
+        d = self.lookupIdentity(nick, verification)
+        d.addCallback(self.verifiedOpping, channel, verification)
+        d.addErrback(self.verificationFailed, nick, channel)
+
+    def verifiedOpping(self, identity, channel, verification):
+        nick = identity.getNickname()
+        cs = self.config.getChannelState(channel)
+
+        # Things might have changed while we were waiting.
+        if not cs or not cs.isOpped():
+            return
+
+        if not cs.hasMember(nick) or cs.hasMemberMode(nick, "o"):
+            return
+
+        member = self.roster.find(nick)
+
+        if member is None or member.getHostmask() is None:
+            return
+
+        # Match whoever is in the channel now, rather than whoever was there
+        # when we started the lookup.
+        matches = self.config.findOperatorCandidates(member.getHostmask(), channel, member.getAccount())
+
+        for match in matches:
+            if "account" in verification and not match.matchAccount(identity.getAccount()):
+                continue
+
+            if "secure" in verification and not identity.isSecure():
+                continue
+
+            print ">>> Verified %s as bot user '%s' on %s" % (nick, match.getName(), channel)
             self.op(channel, nick)
+            return
+
+        print ">>> Unable to verify %s on %s (account: %s, secure: %s)" % (nick, channel, identity.getAccount(), identity.isSecure())
+
+    def verificationFailed(self, failure, nick, channel):
+        print ">>> Verification of %s on %s failed: %s" % (nick, channel, failure.getErrorMessage())
 
     def userLeft(self, user, channel):
         print ">>> %s has left %s" % (user, channel)
@@ -643,12 +2563,33 @@ class Client(irc.IRCClient):
     def userQuit(self, user, quitMessage):
         print ">>> %s has quit: %s" % (user, quitMessage)
 
+        for cs in self.config.getChannelStates():
+            cs.removeMember(user)
+
+        self.roster.remove(user)
+        self.identities.cancel(user)
+
     def userKicked(self, kickee, channel, kicker, message):
         print ">>> %s got kicked by %s on %s: %s" % (kickee, kicker, channel, message)
+        self.removeMember(kickee, channel)
+
+    def userRenamed(self, oldname, newname):
+        print ">>> %s is now known as %s" % (oldname, newname)
+
+        for cs in self.config.getChannelStates():
+            cs.renameMember(oldname, newname)
+
+        self.roster.rename(oldname, newname)
+        self.identities.cancel(oldname)
+        self.identities.cancel(newname)
 
     def kickedFrom(self, channel, kicker, message):
         print ">>> %s kicked us from %s: %s" % (kicker, channel, message)
         self.config.partedChannel(channel)
+
+        for member in self.roster.getMembers():
+            self.forgetMember(member.getNickname())
+
         self.join(channel)
 
     def modeChanged(self, user, channel, added, modes, args):
@@ -670,18 +2611,30 @@ class Client(irc.IRCClient):
         else:
             print ">>> Mode/%s [%c%s %s] by %s" % (channel, c, modes, ' '.join(args), modeChanger)
 
+        self.eventBus.publish(ModeEvent(self, user, channel, added, modes, args))
+
         # Only check for operator mode change.
         pairedModes = zip(modes, args)
+        prefixes = self.supported.getFeature("PREFIX") or {}
+        cs = self.config.getChannelState(channel)
 
         for mode in pairedModes:
             modeChar = mode[0]
             target = mode[1]
 
+            if modeChar in prefixes and cs:
+                cs.setMemberMode(target, modeChar, added)
+
             if modeChar == 'o':
                 if added:
                     self.userOpped(user, target, channel)
                 else:
                     self.userDeopped(user, target, channel)
+            elif modeChar == 'b':
+                if added:
+                    self.banAdded(user, target, channel)
+                else:
+                    self.banRemoved(user, target, channel)
 
     def userOpped(self, user, target, channel):
         # We got opped.
@@ -693,6 +2646,9 @@ class Client(irc.IRCClient):
 
             cs.setOpped(True)
 
+            # Unset any bans which expired while we could not.
+            self.expireBans()
+
     def userDeopped(self, user, target, channel):
         # We got deopped.
         if self.nickname == target:
@@ -703,14 +2659,138 @@ class Client(irc.IRCClient):
 
             cs.setOpped(False)
 
+    def banAdded(self, user, mask, channel):
+        cs = self.config.getChannelState(channel)
+
+        if cs:
+            cs.getBans().add(mask)
+
+    def banRemoved(self, user, mask, channel):
+        cs = self.config.getChannelState(channel)
+
+        if cs:
+            cs.getBans().discard(mask)
+
+    def cmd_ban(self, hostmask, parameters):
+        target = hostmask.getNickname()
+
+        if not self.config.isAdministrator(hostmask, self.getAccount(target)):
+            self.notice(target, "Permission denied")
+            return
+
+        if len(parameters) < 3:
+            self.notice(target, "Usage: ban <channel> <mask> [duration] [reason]")
+            return
+
+        channel = parameters[1]
+        mask = parameters[2]
+        expires = None
+        reason = parameters[3:]
+
+        if not self.config.isSecureMask(mask):
+            self.notice(target, "Insecure mask: '%s'" % mask)
+            return
+
+        if reason:
+            duration = Ban.parseDuration(reason[0])
+
+            if duration is not None:
+                expires = int(self.config.getClock().seconds()) + duration
+                reason = reason[1:]
+
+        ban = Ban(mask, " ".join(reason) or "Banned", expires)
+
+        if not self.config.addBan(channel, ban):
+            self.notice(target, "Unknown channel: '%s'" % channel)
+            return
+
+        self.notice(target, "Added ban for '%s' on %s" % (mask, channel))
+
+        cs = self.config.getChannelState(channel)
+
+        if cs and cs.isOpped():
+            self.queueBan(channel, mask)
+
+    def cmd_unban(self, hostmask, parameters):
+        target = hostmask.getNickname()
+
+        if not self.config.isAdministrator(hostmask, self.getAccount(target)):
+            self.notice(target, "Permission denied")
+            return
+
+        if len(parameters) != 3:
+            self.notice(target, "Usage: unban <channel> <mask>")
+            return
+
+        channel = parameters[1]
+        mask = parameters[2]
+
+        if self.config.removeBan(channel, mask) is None:
+            self.notice(target, "No ban for '%s' on %s" % (mask, channel))
+            return
+
+        self.notice(target, "Removed ban for '%s' on %s" % (mask, channel))
+
+        cs = self.config.getChannelState(channel)
+
+        if cs and cs.isOpped():
+            self.queueUnban(channel, mask)
+
+    def cmd_bans(self, hostmask, parameters):
+        target = hostmask.getNickname()
+
+        if not self.config.isAdministrator(hostmask, self.getAccount(target)):
+            self.notice(target, "Permission denied")
+            return
+
+        if len(parameters) != 2:
+            self.notice(target, "Usage: bans <channel>")
+            return
+
+        bans = self.config.getBans(parameters[1])
+
+        if not bans:
+            self.notice(target, "No bans on %s" % parameters[1])
+            return
+
+        for ban in bans:
+            if ban.getExpires() is None:
+                expires = "never"
+            else:
+                expires = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(ban.getExpires()))
+
+            self.notice(target, "'%s' (expires: %s): %s" % (ban.getMask(), expires, ban.getReason()))
+
+    def cmd_plugins(self, hostmask, parameters):
+        target = hostmask.getNickname()
+
+        if not self.config.isAdministrator(hostmask, self.getAccount(target)):
+            self.notice(target, "Permission denied")
+            return
+
+        runners = self.eventBus.getRunners()
+
+        if not runners:
+            self.notice(target, "No plugins loaded")
+            return
+
+        for runner in runners:
+            if runner.isThreaded():
+                kind = "threaded"
+            else:
+                kind = "inline"
+
+            self.notice(target, "%s (%s): %d processed, %d dropped, %d failed, %d slow" % ((runner.getName(), kind) + runner.getStatistics()))
+
     def cmd_whoami(self, hostmask, parameters):
-        users = self.config.findMatches(hostmask)
         target = hostmask.getNickname()
+        users = self.config.findMatches(hostmask, self.getAccount(target))
 
         if users:
             for user in users:
                 self.notice(target, "Username: '%s'" % user.getName())
                 self.notice(target, "Hostmask: '%s'" % user.getMask())
+                self.notice(target, "Account:  '%s'" % user.getAccount())
                 self.notice(target, "Class:    '%s'" % user.getUserClass())
         else:
             self.notice(target, "Unknown user")
@@ -718,8 +2798,13 @@ class Client(irc.IRCClient):
 class ClientFactory(protocol.ClientFactory):
     protocol = Client
 
-    def __init__(self, config):
+    def __init__(self, config, capture = None):
         self.config = config
+        self.capture = capture
+        self.eventBus = EventBus(config.getPluginThreads())
+
+        if config.getPluginDirectory() is not None:
+            self.eventBus.load(config.getPluginDirectory())
 
     def startedConnecting(self, connector):
         destination = connector.getDestination()
@@ -737,10 +2822,16 @@ class ClientFactory(protocol.ClientFactory):
         reactor.stop()
 
 class Bot(object):
-    def __init__(self, filename):
+    def __init__(self, filename, capture = None):
         config = ConfigurationService(filename)
         server = config.nextServer()
-        clientFactory = ClientFactory(config)
+
+        if capture is not None:
+            print ">>> Capturing traffic to: %s" % capture
+            capture = CaptureWriter(capture)
+            reactor.addSystemEventTrigger("after", "shutdown", capture.close)
+
+        clientFactory = ClientFactory(config, capture)
 
         if server.isSecure():
             reactor.connectSSL(server.getHostname(), server.getPort(), clientFactory, ssl.ClientContextFactory())
@@ -750,10 +2841,164 @@ class Bot(object):
     def runForever(self):
         reactor.run()
 
+class Replay(object):
+    # Outbound commands which depend on the wall clock rather than on what the
+    # server sent us, and therefore are left out of the comparison.
+    ignoredCommands = set(["PING"])
+
+    # Seconds of simulated time after the last record to let pending timers,
+    # such as batched bans, fire.
+    settleTime = 5.0
+
+    def __init__(self, filename, capture, realtime = False):
+        self.config = ConfigurationService(filename, readOnly = True)
+        self.capture = capture
+        self.realtime = realtime
+
+    def load(self):
+        # Only the first connection in the capture is replayed, since later
+        # connections depend on how the previous one went away.
+        inbound = []
+        outbound = []
+        start = None
+        end = 0.0
+        epoch = None
+
+        for timestamp, direction, line in CaptureReader(self.capture):
+            if direction == "*":
+                if start is not None:
+                    print ">>> Capture contains more than one connection; only replaying the first"
+                    break
+
+                # Older captures do not carry the time of day.
+                tmp = line.split(" ")
+
+                if len(tmp) == 2:
+                    epoch = float(tmp[1])
+
+                start = timestamp
+                continue
+
+            if start is None:
+                continue
+
+            end = timestamp - start
+
+            if direction == "<":
+                inbound.append((end, line))
+            elif direction == ">":
+                outbound.append(line)
+
+        return inbound, outbound, end, epoch
+
+    def run(self):
+        # Only needed here, so normal runs do not pull in the test helpers.
+        from twisted.test.proto_helpers import StringTransport
+
+        inbound, expected, end, epoch = self.load()
+
+        if self.realtime:
+            clock = reactor
+        else:
+            clock = task.Clock()
+
+            if epoch is not None:
+                clock.advance(epoch)
+
+            self.config.setClock(clock)
+
+        buf = CaptureBuffer()
+        factory = ClientFactory(self.config, buf)
+        client = factory.buildProtocol(None)
+        client.clock = clock
+        client.heartbeatInterval = None
+
+        # Without a running reactor, results from the plugin thread pool would
+        # never make it back to us.
+        if not self.realtime:
+            factory.eventBus.setInline(True)
+
+        client.makeConnection(StringTransport())
+
+        print ">>> Replaying %d inbound lines covering %.3f seconds" % (len(inbound), end)
+
+        if self.realtime:
+            for timestamp, line in inbound:
+                reactor.callLater(timestamp, client.dataReceived, line + "\r\n")
+
+            reactor.callLater(end + self.settleTime, reactor.stop)
+            reactor.run()
+        else:
+            start = clock.seconds()
+
+            for timestamp, line in inbound:
+                self.advance(clock, start + timestamp)
+                client.dataReceived(line + "\r\n")
+
+            self.advance(clock, start + end + self.settleTime)
+
+        factory.eventBus.stop()
+
+        return self.compare(expected, buf.getLines(">"))
+
+    def advance(self, clock, until):
+        # Step from one timer to the next rather than jumping straight to
+        # until, such that timers scheduled by other timers, like the pacing
+        # of kicks, see the same time as they would in a real run.
+        while True:
+            due = [call.getTime() for call in clock.getDelayedCalls() if call.getTime() <= until]
+
+            if not due:
+                break
+
+            clock.advance(max(0.0, min(due) - clock.seconds()))
+
+        clock.advance(max(0.0, until - clock.seconds()))
+
+    def compare(self, expected, actual):
+        expected = [line for line in expected if line.split(" ", 1)[0] not in self.ignoredCommands]
+        actual = [line for line in actual if line.split(" ", 1)[0] not in self.ignoredCommands]
+
+        if expected == actual:
+            print ">>> Replay matched %d outbound lines" % len(actual)
+            return True
+
+        print ">>> Replay differs from capture:"
+
+        for line in difflib.unified_diff(expected, actual, "capture", "replay", lineterm = ""):
+            print line
+
+        return False
+
 if __name__ == "__main__":
-    if len(sys.argv) < 2:
-        print "Usage: %s path/to/config.json" % sys.argv[0]
+    parser = OptionParser(usage = "Usage: %prog [options] path/to/config.json")
+    parser.add_option("--capture", metavar = "FILE", help = "record all IRC traffic to FILE")
+    parser.add_option("--replay", metavar = "FILE", help = "replay a capture from FILE and compare the outbound lines")
+    parser.add_option("--realtime", action = "store_true", default = False, help = "replay with the original timing")
+    parser.add_option("--profile", metavar = "FILE", help = "write cProfile statistics for the replay to FILE")
+
+    options, args = parser.parse_args()
+
+    if len(args) < 1:
+        parser.print_usage()
         sys.exit(1)
 
-    bot = Bot(sys.argv[1])
-    bot.runForever()
+    if options.replay is None:
+        bot = Bot(args[0], options.capture)
+        bot.runForever()
+        sys.exit(0)
+
+    replay = Replay(args[0], options.replay, options.realtime)
+
+    if options.profile is None:
+        result = replay.run()
+    else:
+        # The statistics can be inspected with pstats or turned into a flame
+        # graph with tools like flameprof.
+        profiler = cProfile.Profile()
+        result = profiler.runcall(replay.run)
+        profiler.dump_stats(options.profile)
+        print ">>> Profile written to: %s" % options.profile
+
+    if not result:
+        sys.exit(1)
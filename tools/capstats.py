@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: set sw=4 sts=4 et tw=120 :
+
+# Summarizes a capture made with bot.py --capture: the number of lines in each
+# direction, WHO and WHOIS queries, the number of ops given and how long after
+# sending JOIN the bot had a complete picture of the channel.
+#
+# Usage: capstats.py capture.gz
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from bot import CaptureReader
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print "Usage: %s capture.gz" % sys.argv[0]
+        sys.exit(1)
+
+    inbound = 0
+    outbound = 0
+    who = 0
+    whois = 0
+    outstanding = 0
+    pipelined = 0
+    ops = 0
+    joined = None
+    synchronized = None
+
+    for timestamp, direction, line in CaptureReader(sys.argv[1]):
+        params = line.split(" ")
+
+        if direction == ">":
+            outbound += 1
+
+            if params[0] == "JOIN" and joined is None:
+                joined = timestamp
+            elif params[0] == "WHO":
+                who += 1
+            elif params[0] == "WHOIS":
+                whois += 1
+                outstanding += 1
+                pipelined = max(pipelined, outstanding)
+            elif params[0] == "MODE" and len(params) > 2 and params[2].startswith("+o"):
+                ops += 1
+        elif direction == "<":
+            inbound += 1
+
+            # The roster is complete at the end of NAMES, unless the bot had
+            # to follow up with a WHO.
+            if len(params) > 1 and params[1] == "366" and synchronized is None:
+                synchronized = timestamp
+            elif len(params) > 1 and params[1] == "315":
+                synchronized = timestamp
+            elif len(params) > 1 and params[1] == "318":
+                outstanding -= 1
+
+    print "lines in:     %d" % inbound
+    print "lines out:    %d" % outbound
+    print "WHO:          %d" % who
+    print "WHOIS:        %d (at most %d outstanding)" % (whois, pipelined)
+    print "ops:          %d" % ops
+
+    if joined is not None and synchronized is not None:
+        print "synchronized: %.3fs after JOIN" % (synchronized - joined)
@@ -0,0 +1,35 @@
+#!/bin/sh
+# Runs the bot against the stand-in ircd with and without IRCv3 capabilities
+# and prints statistics for both captures. Needs a Python 2 with Twisted and
+# simplejson, which can be given in $PYTHON.
+#
+# Usage: tools/measure.sh [roster|verify|flood]
+
+PYTHON=${PYTHON:-python}
+TOOLS=$(dirname "$0")
+SCENARIO=${1:-roster}
+OUT=${OUT:-/tmp}
+
+for mode in caps nocaps; do
+    if [ "$mode" = "caps" ]; then
+        flags="--caps"
+    else
+        flags=""
+    fi
+
+    $PYTHON "$TOOLS/standin_ircd.py" $flags "$SCENARIO" &
+    server=$!
+    sleep 1
+
+    # The bot saves its configuration whenever a ban changes, so give it a
+    # copy. It also reconnects forever, so stop it once the server is gone.
+    cp "$TOOLS/$SCENARIO.json" "$OUT/$SCENARIO-$mode.json"
+    $PYTHON "$TOOLS/../bot.py" --capture "$OUT/$SCENARIO-$mode.gz" "$OUT/$SCENARIO-$mode.json" > "$OUT/$SCENARIO-$mode.log" 2>&1 &
+    bot=$!
+    wait $server
+    kill $bot 2> /dev/null
+    wait $bot 2> /dev/null
+
+    echo "== $SCENARIO, $mode"
+    $PYTHON "$TOOLS/capstats.py" "$OUT/$SCENARIO-$mode.gz"
+done
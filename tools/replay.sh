@@ -0,0 +1,29 @@
+#!/bin/sh
+# Replays the captures in tools/captures against the current bot.py and fails
+# if any of them no longer results in the same outbound lines. A capture named
+# <scenario>-<mode>.gz is replayed with tools/<scenario>.json; new ones can be
+# made with tools/measure.sh. Needs a Python 2 with Twisted and simplejson,
+# which can be given in $PYTHON.
+#
+# Usage: tools/replay.sh
+
+PYTHON=${PYTHON:-python}
+TOOLS=$(dirname "$0")
+LOG=${TMPDIR:-/tmp}/replay.$$.log
+status=0
+
+for capture in "$TOOLS"/captures/*.gz; do
+    name=$(basename "$capture" .gz)
+    scenario=${name%-*}
+
+    if $PYTHON "$TOOLS/../bot.py" --replay "$capture" "$TOOLS/$scenario.json" > "$LOG" 2>&1; then
+        echo "ok:     $name"
+    else
+        echo "FAILED: $name"
+        cat "$LOG"
+        status=1
+    fi
+done
+
+rm -f "$LOG"
+exit $status
@@ -0,0 +1,296 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: set sw=4 sts=4 et tw=120 :
+
+# A stand-in ircd which knows just enough IRC to measure the bot against. It
+# serves a single connection on port 16667 and stops a few seconds after the
+# scenario has played out.
+#
+# Usage: standin_ircd.py [--caps] [--members N] [--latency SECONDS] roster|verify|flood
+#
+# roster: the bot joins #bsd-dk, which already has N members. A second later
+#         one user joins with a services account, one logs in and one gets a
+#         new host.
+#
+# verify: the bot joins #bsd-dk and #thecamp, after which N users join both.
+#         Three out of four are logged in to services and every other one is
+#         using TLS, as WHOIS will tell. While the first WHOIS for crew1 is
+#         on its way, crew1 reconnects, and the WHOIS finds nobody.
+#
+# flood:  the bot joins #bsd-dk, after which N clones join, all of them
+#         caught by a single ban in tools/flood.json. So is [spam]bot, but not
+#         sbot, which joins along with it.
+
+import sys
+
+from optparse import OptionParser
+
+from twisted.internet import protocol, reactor
+from twisted.protocols import basic
+
+CAPABILITIES = ["multi-prefix", "extended-join", "account-notify", "away-notify", "chghost", "userhost-in-names"]
+CHANNEL = "#bsd-dk"
+FLAPPER = "crew1"
+CHANNELS = {
+    "roster": [CHANNEL],
+    "verify": ["#bsd-dk", "#thecamp"],
+    "flood": [CHANNEL]
+}
+
+class StandinServer(basic.LineReceiver):
+    delimiter = "\r\n"
+
+    def connectionMade(self):
+        self.nickname = None
+        self.capabilities = set()
+        self.negotiating = False
+        self.registered = False
+        self.joined = 0
+        self.flapped = False
+
+    def send(self, lines):
+        # Everything a command results in goes out after one trip across the
+        # simulated network.
+        def deliver():
+            for line in lines:
+                self.sendLine(line)
+
+        reactor.callLater(self.factory.latency, deliver)
+
+    def lineReceived(self, line):
+        params = line.split(" ")
+        method = getattr(self, "irc_%s" % params[0], None)
+
+        if method:
+            method(params[1:], line)
+
+    def irc_CAP(self, params, line):
+        if not self.factory.offerCapabilities:
+            self.send([":srv 421 * CAP :Unknown command"])
+            return
+
+        if params[0] == "LS":
+            self.negotiating = True
+            self.send([":srv CAP * LS :%s" % " ".join(CAPABILITIES)])
+        elif params[0] == "REQ":
+            requested = line.split(":", 1)[1].split()
+            self.capabilities.update(requested)
+            self.send([":srv CAP * ACK :%s" % " ".join(requested)])
+        elif params[0] == "END":
+            self.negotiating = False
+            self.welcome()
+
+    def irc_NICK(self, params, line):
+        self.nickname = params[0]
+
+    def irc_USER(self, params, line):
+        if not self.negotiating:
+            self.welcome()
+
+    def irc_PING(self, params, line):
+        self.send([":srv PONG srv %s" % params[0]])
+
+    def welcome(self):
+        if self.registered or self.nickname is None:
+            return
+
+        self.registered = True
+        self.send([
+            ":srv 001 %s :Welcome" % self.nickname,
+            ":srv 005 %s MODES=4 TARGMAX=KICK:4 CHANTYPES=# PREFIX=(ov)@+ :are supported" % self.nickname
+        ])
+
+    def irc_JOIN(self, params, line):
+        if self.factory.scenario != "roster":
+            self.send([
+                ":%s!goto@bot JOIN %s" % (self.nickname, params[0]),
+                ":ChanServ!services@services MODE %s +o %s" % (params[0], self.nickname),
+                ":srv 366 %s %s :End of /NAMES list." % (self.nickname, params[0])
+            ])
+
+            self.joined += 1
+
+            if self.joined == len(CHANNELS[self.factory.scenario]):
+                if self.factory.scenario == "verify":
+                    reactor.callLater(1, self.joinBurst)
+                else:
+                    reactor.callLater(1, self.cloneBurst)
+
+            return
+
+        names = []
+
+        for nickname, username, hostname in self.factory.members:
+            if "userhost-in-names" in self.capabilities:
+                name = "%s!%s@%s" % (nickname, username, hostname)
+            else:
+                name = nickname
+
+            if nickname == "user0":
+                if "multi-prefix" in self.capabilities:
+                    name = "@+" + name
+                else:
+                    name = "@" + name
+
+            names.append(name)
+
+        lines = [
+            ":%s!goto@bot JOIN %s" % (self.nickname, CHANNEL),
+            ":ChanServ!services@services MODE %s +o %s" % (CHANNEL, self.nickname)
+        ]
+
+        for i in range(0, len(names), 20):
+            lines.append(":srv 353 %s = %s :%s" % (self.nickname, CHANNEL, " ".join(names[i:i + 20])))
+
+        lines.append(":srv 366 %s %s :End of /NAMES list." % (self.nickname, CHANNEL))
+
+        self.send(lines)
+        reactor.callLater(1, self.afterJoin)
+
+    def irc_WHO(self, params, line):
+        lines = []
+
+        for nickname, username, hostname in self.factory.members:
+            if nickname == "user0":
+                flags = "H@"
+            else:
+                flags = "H"
+
+            lines.append(":srv 352 %s %s %s %s srv %s %s :0 Real Name" % (self.nickname, CHANNEL, username, hostname,
+                                                                           nickname, flags))
+
+        lines.append(":srv 315 %s %s :End of /WHO list." % (self.nickname, CHANNEL))
+        self.send(lines)
+
+    def irc_WHOIS(self, params, line):
+        nickname = params[0]
+        user = self.factory.users.get(nickname.lower())
+
+        lines = []
+
+        # As if the query was answered by a server which had yet to learn that
+        # the user is back.
+        if user is not None and nickname.lower() == FLAPPER and not self.flapped:
+            self.flapped = True
+            lines.append(":%s!%s@%s QUIT :Ping timeout" % (nickname, user[1], user[2]))
+            lines.extend(self.joinLines(*user[:4]))
+            user = None
+
+        if user is None:
+            lines.append(":srv 401 %s %s :No such nick/channel" % (self.nickname, nickname))
+            lines.append(":srv 318 %s %s :End of /WHOIS list." % (self.nickname, nickname))
+            self.send(lines)
+            return
+
+        lines.append(":srv 311 %s %s %s %s * :Real Name" % (self.nickname, nickname, user[1], user[2]))
+
+        if user[3] is not None:
+            lines.append(":srv 330 %s %s %s :is logged in as" % (self.nickname, nickname, user[3]))
+
+        if user[4]:
+            lines.append(":srv 671 %s %s :is using a secure connection" % (self.nickname, nickname))
+
+        lines.append(":srv 318 %s %s :End of /WHOIS list." % (self.nickname, nickname))
+        self.send(lines)
+
+    def joinLines(self, nickname, username, hostname, account):
+        lines = []
+
+        for channel in CHANNELS["verify"]:
+            if "extended-join" in self.capabilities:
+                lines.append(":%s!%s@%s JOIN %s %s :Real Name" % (nickname, username, hostname, channel, account or "*"))
+            else:
+                lines.append(":%s!%s@%s JOIN %s" % (nickname, username, hostname, channel))
+
+        return lines
+
+    def joinBurst(self):
+        lines = []
+
+        for nickname, username, hostname, account, secure in self.factory.users.values():
+            lines.extend(self.joinLines(nickname, username, hostname, account))
+
+        self.send(lines)
+        reactor.callLater(2, self.transport.loseConnection)
+        reactor.callLater(3, reactor.stop)
+
+    def cloneBurst(self):
+        lines = []
+
+        for i in range(self.factory.memberCount):
+            if "extended-join" in self.capabilities:
+                lines.append(":clone%d!clone@c%d.clones.example.org JOIN %s * :Clone" % (i, i, CHANNEL))
+            else:
+                lines.append(":clone%d!clone@c%d.clones.example.org JOIN %s" % (i, i, CHANNEL))
+
+        lines.append(":[spam]bot!spam@spam.example.org JOIN %s" % CHANNEL)
+        lines.append(":sbot!sbot@innocent.example.org JOIN %s" % CHANNEL)
+
+        self.send(lines)
+
+        # The bot paces its kicks, so give them time to arrive.
+        reactor.callLater(10, self.transport.loseConnection)
+        reactor.callLater(11, reactor.stop)
+
+    def afterJoin(self):
+        if "extended-join" in self.capabilities:
+            lines = [":tyk!tykling@gibfest.dk JOIN %s tykling :Thomas" % CHANNEL]
+        else:
+            lines = [":tyk!tykling@gibfest.dk JOIN %s" % CHANNEL]
+
+        if "account-notify" in self.capabilities:
+            lines.append(":user5!u5@h5.example.org ACCOUNT hulli")
+
+        if "chghost" in self.capabilities:
+            lines.append(":user6!u6@h6.example.org CHGHOST fj wonko.batmule.dk")
+
+        self.send(lines)
+        reactor.callLater(1, self.transport.loseConnection)
+        reactor.callLater(2, reactor.stop)
+
+class StandinFactory(protocol.ServerFactory):
+    protocol = StandinServer
+
+    def __init__(self, scenario, offerCapabilities, members, latency):
+        self.scenario = scenario
+        self.offerCapabilities = offerCapabilities
+        self.latency = latency
+        self.memberCount = members
+        self.members = [("user%d" % i, "u%d" % i, "h%d.example.org" % i) for i in range(members)]
+        self.users = {}
+
+        for i in range(members):
+            if i % 4:
+                account = "crew%d" % i
+            else:
+                account = None
+
+            self.users["crew%d" % i] = ("crew%d" % i, "crew", "h%d.example.org" % i, account, i % 2 == 0)
+
+if __name__ == "__main__":
+    parser = OptionParser(usage = "Usage: %prog [options] roster|verify|flood")
+    parser.add_option("--caps", action = "store_true", default = False, help = "offer IRCv3 capabilities")
+    parser.add_option("--members", type = "int", default = None, help = "number of channel members, users or clones")
+    parser.add_option("--latency", type = "float", default = 0.05, help = "one way latency in seconds")
+
+    options, args = parser.parse_args()
+
+    if len(args) != 1 or args[0] not in CHANNELS:
+        parser.print_usage()
+        sys.exit(1)
+
+    members = options.members
+
+    if members is None:
+        if args[0] == "roster":
+            members = 200
+        elif args[0] == "verify":
+            members = 20
+        else:
+            members = 30
+
+    reactor.listenTCP(16667, StandinFactory(args[0], options.caps, members, options.latency), interface = "127.0.0.1")
+
+    # Give up if the bot never shows up.
+    reactor.callLater(30, reactor.stop)
+    reactor.run()